@@ -8,96 +8,486 @@
 #   A Pull Request Review Script
 #
 
+import os
+import sys
+import dbm
+import time
 import typer
+import random
+import orjson
+import pickle
+import shelve
 import requests
-import base64
 import tiktoken
-
+import threading
+
+from hashlib import blake2b
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qs, quote, urlparse
+from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from typer.params import Option
+from typing import Callable, Iterator
 from typing_extensions import Annotated
 
 DEBUG = False
 
+POOL_SIZE = 16
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+
+RAW_URL = 'https://raw.githubusercontent.com'
+
+# largest page size the github rest api serves
+MAX_PER_PAGE = 100
+
+# drops the session's authorization header from a request
+ANONYMOUS_HEADERS = {'Authorization': None}
+
+# whether each owner/name repository answered raw fetches only when authenticated
+_private_repos: dict[str, bool] = {}
+
+CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'prreviewer', 'etags')
+
+CACHE_SIZE = 256
+
+CACHE_ERRORS = (OSError, ValueError, pickle.UnpicklingError, *dbm.error)
+
+_cache_lock = threading.Lock()
+
+TOKEN_CACHE_SIZE = 10_000
+
+_token_counts: dict[bytes, int] = {}
+
+# loose upper bound on the characters per token of cl100k_base (~3.8 avg)
+CHARS_PER_TOKEN = 5
+
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+
+# stays under the 5000 requests/hour primary rate limit
+RATE_LIMIT = 4500 / 3600
+RATE_LIMIT_BURST = 50
+MAX_RETRIES = 5
+MAX_BACKOFF = 60
+# longer rate limit waits fail the run instead of looking like a hang
+MAX_RATE_LIMIT_WAIT = MAX_BACKOFF * 10
+# github asks to wait at least a minute after a secondary rate limit
+SECONDARY_RATE_LIMIT_WAIT = 60
+
+
+class TokenBucket:
+    """ admits calls at a steady rate, allowing bursts up to its capacity """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self):
+        """ takes a token, waiting until one is available """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+BUCKET = TokenBucket(RATE_LIMIT, RATE_LIMIT_BURST)
+
+
+def parse_retry_after(value: str) -> float | None:
+    """ returns the seconds of a Retry-After header, in seconds or http date form """
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(response: requests.Response, attempt: int) -> float | None:
+    """ returns how long to wait before retrying a rate limited response """
+
+    if response.status_code not in (403, 429):
+        return None
+
+    headers = response.headers
+    if 'Retry-After' in headers:
+        delay = parse_retry_after(headers['Retry-After'])
+        if delay is not None:
+            return delay
+
+    if headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in headers:
+        return max(float(headers['X-RateLimit-Reset']) - time.time(), 0)
+
+    if 'secondary rate limit' in response.text.lower():
+        return SECONDARY_RATE_LIMIT_WAIT * 2 ** attempt + random.random()
+
+    # any other 403 is a permission error
+    if response.status_code == 403:
+        return None
+
+    return min(2 ** attempt + random.random(), MAX_BACKOFF)
+
+
+def with_ratelimit(bucket: TokenBucket | None):
+    """ paces the calls to request with bucket, if any, and retries rate limited responses """
+
+    def decorator(request):
+        @wraps(request)
+        def wrapper(*args, **kwargs) -> requests.Response:
+            for attempt in range(MAX_RETRIES + 1):
+                if bucket:
+                    bucket.consume()
+                response = request(*args, **kwargs)
+
+                delay = retry_delay(response, attempt)
+                if delay is None or attempt == MAX_RETRIES:
+                    return response
+
+                if delay > MAX_RATE_LIMIT_WAIT:
+                    raise Exception(
+                        f"Rate limited by GitHub, the limit resets in {delay:.0f}s")
+
+                print(f"!!!WARN: rate limited by GitHub, retrying in {delay:.0f}s\n",
+                      file=sys.stderr)
+                time.sleep(delay)
+
+        return wrapper
+
+    return decorator
+
+
+@with_ratelimit(BUCKET)
+def send(method: str, url: str, **kwargs) -> requests.Response:
+    """ sends a request to the github api through the shared session """
+
+    return SESSION.request(method, url, **kwargs)
+
+
+# the raw cdn is outside the api quota, so its fetches are not paced
+@with_ratelimit(None)
+def send_raw(url: str, **kwargs) -> requests.Response:
+    """ gets a raw file through the shared session """
+
+    return SESSION.get(url, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def _encoder(model: str = "gpt-3.5-turbo") -> tiktoken.Encoding:
+    """ returns the encoding of the given model, loaded only once """
+
+    return tiktoken.encoding_for_model(model)
+
+
+@lru_cache(maxsize=None)
+def _max_token_len() -> int:
+    """ returns the length in bytes of the longest token of the encoding """
+
+    return max(len(token) for token in _encoder().token_byte_values())
+
+
+def _token_key(message: str) -> bytes:
+    """ returns the token count cache key of the given message """
+
+    return blake2b(message.encode('utf-8'), digest_size=16).digest()
+
+
+def _store_token_count(key: bytes, count: int):
+    """ caches a token count, dropping the oldest half once full """
+
+    # dicts keep insertion order
+    if len(_token_counts) >= TOKEN_CACHE_SIZE:
+        for old in list(_token_counts)[:TOKEN_CACHE_SIZE // 2]:
+            del _token_counts[old]
+
+    _token_counts[key] = count
+
 
 def count_tokens(message: str) -> int:
     """ returns the count of tokens of the given message """
 
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    tokens = encoding.encode(message)
+    key = _token_key(message)
+    count = _token_counts.get(key)
+    if count is not None:
+        return count
+
+    # special token text such as <|endoftext|> is counted as plain text
+    count = len(_encoder().encode_ordinary(message))
+    _store_token_count(key, count)
+
+    return count
+
+
+def count_tokens_capped(message: str, cap: int) -> int:
+    """ returns the count of tokens of the given message, or cap + 1 if over it """
 
-    return len(tokens)
+    prefix = message[:cap * CHARS_PER_TOKEN]
+    count = count_tokens(prefix)
+    if count > cap:
+        return cap + 1
 
+    # a token spans at most _max_token_len() characters, so a longer message
+    # cannot fit in cap tokens
+    if len(message) > cap * _max_token_len():
+        return cap + 1
 
-def string_to_base64(s):
-    return base64.b64encode(s.encode('utf-8'))
+    # the prefix fit, only a message longer than it needs a full count
+    if len(prefix) < len(message):
+        count = count_tokens(message)
 
+    return min(count, cap + 1)
 
-def base64_to_string(b):
-    return base64.b64decode(b).decode('utf-8')
 
+def count_tokens_batch(messages: list[str], cap: int) -> list[int]:
+    """ returns count_tokens_capped of each message, encoding the prefixes in one batch """
 
-def get_file_content(url: str, gh_token: str) -> str:
+    prefixes = [message[:cap * CHARS_PER_TOKEN] for message in messages]
+    for prefix, tokens in zip(prefixes, _encoder().encode_ordinary_batch(prefixes)):
+        _store_token_count(_token_key(prefix), len(tokens))
+
+    # the prefix counts are now cached, only long messages that fit are encoded again
+    return [count_tokens_capped(message, cap) for message in messages]
+
+
+def _open_cache() -> shelve.Shelf:
+    """ opens the etag cache, readable only by the current user """
+
+    os.makedirs(os.path.dirname(CACHE_PATH), mode=0o700, exist_ok=True)
+
+    return shelve.Shelf(dbm.open(CACHE_PATH, 'c', 0o600))
+
+
+def cache_load(url: str) -> tuple[str | None, bytes | None]:
+    """ gets the cached etag and body of the url, if any """
+
+    with _cache_lock:
+        try:
+            with _open_cache() as cache:
+                _, etag, content = cache.get(url, (None, None, None))
+                return etag, content
+        except CACHE_ERRORS:
+            # the cache is best effort, a broken one only costs a full fetch
+            return None, None
+
+
+def cache_store(url: str, etag: str, content: bytes):
+    """ caches the etag and body of the url """
+
+    with _cache_lock:
+        try:
+            with _open_cache() as cache:
+                # drops the oldest half once full
+                if len(cache) >= CACHE_SIZE:
+                    stored = sorted(cache, key=lambda key: cache[key][0])
+                    for old in stored[:CACHE_SIZE // 2]:
+                        del cache[old]
+
+                cache[url] = (time.time(), etag, content)
+        except CACHE_ERRORS:
+            pass
+
+
+def cached_get(url: str) -> tuple[int, bytes]:
+    """ gets the url, revalidating a previous response by its etag """
+
+    etag, content = cache_load(url)
+
+    headers = {'If-None-Match': etag} if etag else {}
+    response = send('GET', url, headers=headers)
+
+    if response.status_code == 304 and content is not None:
+        return 200, content
+
+    if response.status_code == 200 and 'ETag' in response.headers:
+        cache_store(url, response.headers['ETag'], response.content)
+
+    return response.status_code, response.content
+
+
+def raw_file_url(file: dict, repo_ownr: str, repo_name: str) -> str:
+    """ gets the raw url of a file of the pull request files list """
+
+    ref = parse_qs(urlparse(file['contents_url']).query)['ref'][0]
+
+    return f'{RAW_URL}/{repo_ownr}/{repo_name}/{ref}/{quote(file["filename"])}'
+
+
+def get_file_content(url: str) -> str:
     """ get the file content """
 
-    headers = {
-        'Authorization': f'token {gh_token}',
-        'Accept': 'application/vnd.github+json',
-    }
+    repo = '/'.join(urlparse(url).path.split('/')[1:3])
+    private = _private_repos.get(repo)
+
+    # raw urls are pinned to a commit, so they are not worth an etag cache
+    # entry, and anonymous requests are served from the cdn cache
+    if not private:
+        response = send_raw(url, headers=ANONYMOUS_HEADERS)
+        if response.status_code == 200:
+            _private_repos[repo] = False
+
+    # private repositories only serve authenticated requests, a 404 from a
+    # repository known to be public is a missing file
+    if private or (private is None and response.status_code == 404):
+        response = send_raw(url)
+        if response.status_code == 200:
+            _private_repos[repo] = True
 
-    response = requests.get(url, headers=headers)
     if response.status_code != 200:
         raise Exception(
             f"Error fetching file contents: {response.status_code}")
 
-    return base64_to_string(response.json()['content'])
+    return response.content.decode('utf-8', errors='replace')
 
 
-def get_pr_file_list(pr_number: str, repo_ownr: str, repo_name: str, gh_token: str):
-    """ get list of files and chuncks """
+def get_blobs(shas: list[str], repo_ownr: str, repo_name: str) -> list[dict | None]:
+    """ get the text of several blobs in a single graphql query """
 
-    file_list = []
+    if not shas:
+        return []
 
-    url = f'https://api.github.com/repos/{repo_ownr}/{repo_name}/pulls/{pr_number}/files'
-    headers = {
-        'Authorization': f'token {gh_token}',
-        'Accept': 'application/vnd.github+json',
-    }
-    response = requests.get(url, headers=headers)
+    params = ', '.join(f'$f{i}: GitObjectID!' for i in range(len(shas)))
+    fields = '\n'.join(
+        f'f{i}: object(oid: $f{i}) {{ ... on Blob {{ text isTruncated isBinary }} }}'
+        for i in range(len(shas)))
+    query = (
+        f'query($owner: String!, $name: String!, {params}) {{\n'
+        f'repository(owner: $owner, name: $name) {{\n{fields}\n}}\n}}'
+    )
+
+    variables = {f'f{i}': sha for i, sha in enumerate(shas)}
+    variables['owner'] = repo_ownr
+    variables['name'] = repo_name
+
+    response = send(
+        'POST', GRAPHQL_URL, json={'query': query, 'variables': variables})
     if response.status_code != 200:
-        raise Exception(f"Error fetching pull request: {response.status_code}")
+        raise Exception(f"Error fetching file contents: {response.status_code}")
 
-    for file in response.json():
-        file_list.append(
-            (
-                file['filename'],
-                file['patch'],
-                get_file_content(file['contents_url'], gh_token)
-            )
-        )
+    payload = orjson.loads(response.content)
+    if payload.get('errors'):
+        raise Exception(
+            f"Error fetching file contents: {payload['errors'][0]['message']}")
+
+    blobs = payload['data']['repository']
+
+    return [blobs[f'f{i}'] for i in range(len(shas))]
+
+
+def needs_raw_fetch(blob: dict | None) -> bool:
+    """ whether the text of a blob has to be fetched from the raw cdn """
+
+    return not blob or blob.get('isTruncated') or blob.get('text') is None
+
+
+def get_pr_files(pr_number: str, repo_ownr: str, repo_name: str, max_files: int) -> list[dict]:
+    """ gets the first max_files entries of the pull request files list """
+
+    per_page = min(max_files, MAX_PER_PAGE)
+
+    files = []
+    page = 1
+    while len(files) < max_files:
+        url = f'https://api.github.com/repos/{repo_ownr}/{repo_name}/pulls/{pr_number}/files?per_page={per_page}&page={page}'
+        status_code, content = cached_get(url)
+        if status_code != 200:
+            raise Exception(f"Error fetching pull request: {status_code}")
+
+        entries = orjson.loads(content)
+        files.extend(entries)
+
+        # a short page is the last one
+        if len(entries) < per_page:
+            break
+        page += 1
+
+    return files[:max_files]
+
+
+def get_pr_file_list(pr_number: str, repo_ownr: str, repo_name: str, max_files: int) -> Iterator[list[tuple[str, str, str]]]:
+    """ yields batches of files and chuncks as their contents become available """
+
+    files = get_pr_files(pr_number, repo_ownr, repo_name, max_files)
+
+    executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+    try:
+        futures = {}
 
-    return file_list
+        # one graphql query per page keeps each query at a bounded size, and
+        # each page is handed out before the next one is queried
+        for start in range(0, len(files), MAX_PER_PAGE):
+            page = files[start:start + MAX_PER_PAGE]
+            blobs = get_blobs(
+                [file['sha'] for file in page], repo_ownr, repo_name)
 
+            # binary files have no text to review
+            page_blobs = [
+                (file, blob) for file, blob in zip(page, blobs)
+                if not (blob and blob.get('isBinary'))
+            ]
 
-def get_pr_data(pr_number: str, repo_ownr: str, repo_name: str, gh_token: str) -> requests.Response:
+            # the raw fetches start before the graphql texts are handed out,
+            # so they download while those are reviewed
+            for file, blob in page_blobs:
+                if needs_raw_fetch(blob):
+                    future = executor.submit(
+                        get_file_content, raw_file_url(file, repo_ownr, repo_name))
+                    futures[future] = file
+
+            # the graphql texts of a page arrive together and are handed out
+            # as one batch
+            batch = [
+                (file['filename'], file['patch'], blob['text'])
+                for file, blob in page_blobs if not needs_raw_fetch(blob)
+            ]
+            if batch:
+                yield batch
+
+            # raw fetches finished meanwhile need not wait for the next pages
+            for future in [future for future in futures if future.done()]:
+                file = futures.pop(future)
+                yield [(file['filename'], file['patch'], future.result())]
+
+        for future in as_completed(futures):
+            file = futures[future]
+            yield [(file['filename'], file['patch'], future.result())]
+    finally:
+        # a consumer stopping early does not wait for pending downloads
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_pr_data(pr_number: str, repo_ownr: str, repo_name: str) -> dict:
     """ gets the pull request title """
 
     url = f'https://api.github.com/repos/{repo_ownr}/{repo_name}/pulls/{pr_number}'
-    headers = {
-        'Authorization': f'token {gh_token}',
-        'Accept': 'application/vnd.github+json',
-    }
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Error fetching pull request: {response.status_code}")
-    return response
+    status_code, content = cached_get(url)
+    if status_code != 200:
+        raise Exception(f"Error fetching pull request: {status_code}")
+    return orjson.loads(content)
 
 
-def printout(fstring: str, mode: bool):
-    """ prints out if set to verbose """
+def printout(fstring: str | Callable[[], str], mode: bool):
+    """ prints out if set to verbose, fstring may be a callable building it """
 
-    output = mode | DEBUG
-    if output:
-        print(fstring)
+    if mode or DEBUG:
+        print(fstring() if callable(fstring) else fstring)
 
 
 def print_script_signature(pr_number: str, repo_ownr: str, repo_name: str, verbose: bool):
@@ -107,10 +497,7 @@ def print_script_signature(pr_number: str, repo_ownr: str, repo_name: str, verbo
 
     len_signature = len(signature) - 2
 
-    for _ in range(len_signature):
-        signature += '='
-
-    signature = signature + '\n'
+    signature += '=' * len_signature + '\n'
 
     printout(signature, verbose)
 
@@ -133,7 +520,7 @@ def main(
         help="Option to enable verbose mode")] = False,
 
     max_files: int = Option(
-        30, help="Option to set the max number of files reviewed"),
+        30, min=1, help="Option to set the max number of files reviewed"),
     max_tokens: int = Option(
         4096, help="Option to set the max number of tokens"),
     max_input_tokens: int = Option(
@@ -167,34 +554,49 @@ def main(
     if max_input_tokens == max_tokens:
         print("!!!WARN: `max_input_tokens = max_tokens` (not recommended)\n")
 
+    needs_api = review_title or review_body or review_diffs
+    if not needs_api:
+        return
+
+    SESSION.headers.update({
+        'Authorization': f'token {gh_token}',
+        'Accept': 'application/vnd.github+json',
+    })
+
     pr_title: str
     pr_body: str
 
     if review_title or review_body:
-        pr_data = get_pr_data(str(pr_number), repo_ownr,
-                              repo_name, gh_token).json()
+        pr_data = get_pr_data(str(pr_number), repo_ownr, repo_name)
         pr_title = pr_data['title']
         pr_body = pr_data['body']
 
         if review_title != False:
             printout("Reviewing the title:", verbose)
             # TODO: implement title review code
-            printout(f'\t{pr_title}', verbose)
+            printout(lambda: f'\t{pr_title}', verbose)
 
         if review_body != False:
             printout("Reviewing the body:", verbose)
             # TODO: implement body review code
-            printout(f'\t{pr_body}', verbose)
+            printout(lambda: f'\t{pr_body}', verbose)
 
     if review_diffs != False:
         printout("Reviewing the files:", verbose)
 
-        changed_files = get_pr_file_list(
-            str(pr_number), repo_ownr, repo_name, gh_token)
+        for changed_files in get_pr_file_list(str(pr_number), repo_ownr, repo_name, max_files):
+            token_counts = count_tokens_batch(
+                [content for _, _, content in changed_files], max_input_tokens_pf)
 
-        for file in changed_files:
-            # TODO: implement file review code
-            pass
+            for file, token_count in zip(changed_files, token_counts):
+                filename, patch, content = file
+
+                if token_count > max_input_tokens_pf:
+                    printout(
+                        lambda: f'\tskipping {filename}: over max_input_tokens_pf', verbose)
+                    continue
+
+                # TODO: implement file review code
 
 
 if __name__ == '__main__':